@@ -1,7 +1,251 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 import sys
+import os
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+try:
+    import cupy
+except ImportError:
+    cupy = None
+
+
+#Integer codes of the option and barrier types, the strings are only looked up once per contract
+CALL, PUT = 0, 1
+UP_OUT, DOWN_OUT, UP_IN, DOWN_IN = 0, 1, 2, 3
+
+OPTION_CODES  = {"call": CALL, "put": PUT}
+BARRIER_CODES = {"up_and_out": UP_OUT, "down_and_out": DOWN_OUT, "up_and_in": UP_IN, "down_and_in": DOWN_IN}
+
+#Bytes of path tile kept resident in cache (a typical per-core L2) while it goes through cumsum and the payoff
+CACHE_BYTES = 1024*1024
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _seed_kernel(seed):
+        np.random.seed(seed)
+
+
+    @numba.njit(fastmath=True, cache=True)
+    def _path_payoff(log_price, log_extreme, log_B, K, is_call, is_up, is_out):
+        if is_up:
+            barrier_reached = log_extreme >= log_B
+        else:
+            barrier_reached = log_extreme <= log_B
+
+        if barrier_reached == is_out:
+            return 0.0
+        if is_call:
+            return max(np.exp(log_price) - K, 0.0)
+        return max(K - np.exp(log_price), 0.0)
+
+
+    @numba.njit(fastmath=True, cache=True)
+    def _bridge_extreme(previous_log_price, log_price, step_volatility, is_up):
+        #Sampled maximum (minimum) of the Brownian bridge joining two consecutive log prices
+        spread = np.sqrt((log_price - previous_log_price)**2 - 2*step_volatility**2*np.log(1.0 - np.random.random()))
+        if is_up:
+            return 0.5*(previous_log_price + log_price + spread)
+        return 0.5*(previous_log_price + log_price - spread)
+
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _mc_kernel(num_iters, steps, log_S0, step_drift, step_volatility, log_B, K, option_code, barrier_code, antithetic, brownian_bridge):
+        """
+        Walk every path in a single fused loop keeping only the running log price and running extreme,
+        and return the sum of the undiscounted payoffs and the sum of squares of the independent samples
+        (antithetic pairs count as a single sample, averaging both paths).
+        The codes and flags are ordinary runtime arguments, a single version is compiled and the loop
+        branches on them, which costs little next to drawing the normals
+        """
+        is_call = option_code == CALL
+        is_up = barrier_code == UP_OUT or barrier_code == UP_IN
+        is_out = barrier_code == UP_OUT or barrier_code == DOWN_OUT
+        num_samples = (num_iters + 1)//2 if antithetic else num_iters
+        payoff_sum = 0.0
+        payoff_sum_squares = 0.0
+        for sample in numba.prange(num_samples):
+            log_price = log_S0
+            log_extreme = log_S0
+            mirrored_log_price = log_S0
+            mirrored_log_extreme = log_S0
+            for step in range(steps):
+                shock = step_volatility*np.random.normal()
+                previous_log_price = log_price
+                log_price += step_drift + shock
+                crossing = _bridge_extreme(previous_log_price, log_price, step_volatility, is_up) if brownian_bridge else log_price
+                if is_up:
+                    log_extreme = max(log_extreme, crossing)
+                else:
+                    log_extreme = min(log_extreme, crossing)
+
+                if antithetic:
+                    previous_log_price = mirrored_log_price
+                    mirrored_log_price += step_drift - shock
+                    crossing = _bridge_extreme(previous_log_price, mirrored_log_price, step_volatility, is_up) if brownian_bridge else mirrored_log_price
+                    if is_up:
+                        mirrored_log_extreme = max(mirrored_log_extreme, crossing)
+                    else:
+                        mirrored_log_extreme = min(mirrored_log_extreme, crossing)
+
+            payoff = _path_payoff(log_price, log_extreme, log_B, K, is_call, is_up, is_out)
+            if antithetic and 2*sample + 1 < num_iters:
+                mirrored_payoff = _path_payoff(mirrored_log_price, mirrored_log_extreme, log_B, K, is_call, is_up, is_out)
+                payoff_sum += payoff + mirrored_payoff
+                payoff = 0.5*(payoff + mirrored_payoff)
+            else:
+                payoff_sum += payoff
+            payoff_sum_squares += payoff*payoff
+
+        return payoff_sum, payoff_sum_squares
+
+
+#Vanilla payoffs compiled as numba ufuncs, a single elementwise loop with no temporaries.
+#They are only compiled (or loaded from the cache) on first use so that importing the module stays cheap,
+#and run on the calling thread since the NumPy engine already spreads tiles over a thread pool
+def _call_payoff(S, K):
+    return max(S - K, 0.0)
+
+
+def _put_payoff(S, K):
+    return max(K - S, 0.0)
+
+
+_payoff_ufuncs = {}
+_payoff_ufuncs_lock = threading.Lock()
+
+
+def _payoff_ufunc(option_code):
+    """
+    Return the compiled vanilla payoff ufunc of option_code, building it on the first call
+    """
+    ufunc = _payoff_ufuncs.get(option_code)
+    if ufunc is None:
+        with _payoff_ufuncs_lock:
+            if option_code not in _payoff_ufuncs:
+                _payoff_ufuncs[option_code] = numba.vectorize(["float32(float32, float32)", "float64(float64, float64)"], fastmath=True,
+                                                              cache=True)(_call_payoff if option_code == CALL else _put_payoff)
+            ufunc = _payoff_ufuncs[option_code]
+
+    return ufunc
+
+
+#One CUDA thread per path (or antithetic pair), each with its own Philox stream, the sums are reduced per block
+#and accumulated into two global sums, whose unordered atomic additions make them reproducible only up to rounding
+_CUDA_KERNEL_SOURCE = r'''
+#include <curand_kernel.h>
+
+__device__ double path_payoff(double log_price, double log_extreme, double log_B, double K, int is_call, int is_up, int is_out)
+{
+    bool barrier_reached = is_up ? log_extreme >= log_B : log_extreme <= log_B;
+    if (barrier_reached == (bool)is_out) {
+        return 0.0;
+    }
+    return is_call ? fmax(exp(log_price) - K, 0.0) : fmax(K - exp(log_price), 0.0);
+}
+
+__device__ double bridge_extreme(double previous_log_price, double log_price, double step_volatility, int is_up, curandStatePhilox4_32_10_t* state)
+{
+    double spread = sqrt((log_price - previous_log_price)*(log_price - previous_log_price)
+                         - 2*step_volatility*step_volatility*log(curand_uniform_double(state)));
+    return 0.5*(previous_log_price + log_price + (is_up ? spread : -spread));
+}
+
+__device__ void simulate_sample(long long sample, long long num_iters, int steps, double log_S0, double step_drift, double step_volatility,
+                                double log_B, double K, int is_call, int is_up, int is_out, int antithetic, int brownian_bridge,
+                                unsigned long long seed, double* payoff_sum, double* payoff_square)
+{
+    curandStatePhilox4_32_10_t state;
+    curand_init(seed, sample, 0, &state);
+
+    double log_price = log_S0, log_extreme = log_S0;
+    double mirrored_log_price = log_S0, mirrored_log_extreme = log_S0;
+    for (int step = 0; step < steps; step++) {
+        double shock = step_volatility*curand_normal_double(&state);
+        double previous_log_price = log_price;
+        log_price += step_drift + shock;
+        double crossing = brownian_bridge ? bridge_extreme(previous_log_price, log_price, step_volatility, is_up, &state) : log_price;
+        log_extreme = is_up ? fmax(log_extreme, crossing) : fmin(log_extreme, crossing);
+        if (antithetic) {
+            previous_log_price = mirrored_log_price;
+            mirrored_log_price += step_drift - shock;
+            crossing = brownian_bridge ? bridge_extreme(previous_log_price, mirrored_log_price, step_volatility, is_up, &state) : mirrored_log_price;
+            mirrored_log_extreme = is_up ? fmax(mirrored_log_extreme, crossing) : fmin(mirrored_log_extreme, crossing);
+        }
+    }
+
+    double payoff = path_payoff(log_price, log_extreme, log_B, K, is_call, is_up, is_out);
+    *payoff_sum = payoff;
+    if (antithetic && 2*sample + 1 < num_iters) {
+        double mirrored_payoff = path_payoff(mirrored_log_price, mirrored_log_extreme, log_B, K, is_call, is_up, is_out);
+        *payoff_sum += mirrored_payoff;
+        payoff = 0.5*(payoff + mirrored_payoff);
+    }
+    *payoff_square = payoff*payoff;
+}
+
+__device__ void warp_sum(double* payoff_sum, double* payoff_square)
+{
+    for (int offset = warpSize/2; offset > 0; offset /= 2) {
+        *payoff_sum += __shfl_down_sync(0xffffffff, *payoff_sum, offset);
+        *payoff_square += __shfl_down_sync(0xffffffff, *payoff_square, offset);
+    }
+}
+
+//Launched with a multiple of 32 threads per block, at most 1024
+extern "C" __global__
+void mc_kernel(long long num_iters, long long num_samples, int steps, double log_S0, double step_drift, double step_volatility,
+               double log_B, double K, int is_call, int is_up, int is_out, int antithetic, int brownian_bridge,
+               unsigned long long seed, double* sums)
+{
+    __shared__ double warp_sums[32];
+    __shared__ double warp_squares[32];
+
+    //Threads past the last sample contribute zeros, so every thread takes part in the reduction
+    long long sample = (long long)blockIdx.x*blockDim.x + threadIdx.x;
+    double payoff_sum = 0.0, payoff_square = 0.0;
+    if (sample < num_samples) {
+        simulate_sample(sample, num_iters, steps, log_S0, step_drift, step_volatility, log_B, K, is_call, is_up, is_out,
+                        antithetic, brownian_bridge, seed, &payoff_sum, &payoff_square);
+    }
+
+    //Reduce within each warp with shuffles, then across the warps of the block in shared memory
+    int lane = threadIdx.x % warpSize;
+    int warp = threadIdx.x / warpSize;
+    warp_sum(&payoff_sum, &payoff_square);
+    if (lane == 0) {
+        warp_sums[warp] = payoff_sum;
+        warp_squares[warp] = payoff_square;
+    }
+    __syncthreads();
+
+    if (warp == 0) {
+        int num_warps = blockDim.x / warpSize;
+        payoff_sum = lane < num_warps ? warp_sums[lane] : 0.0;
+        payoff_square = lane < num_warps ? warp_squares[lane] : 0.0;
+        warp_sum(&payoff_sum, &payoff_square);
+
+        //A single pair of atomics per block
+        if (lane == 0) {
+            atomicAdd(&sums[0], payoff_sum);
+            atomicAdd(&sums[1], payoff_square);
+        }
+    }
+}
+'''
+
+if cupy is not None:
+    _cuda_kernel = cupy.RawKernel(_CUDA_KERNEL_SOURCE, "mc_kernel")
+
 
 class BarrierOption():
     def __init__(self, option_type, barrier_type, S0, K, B, T, volatility, risk_free_rate) -> None:
@@ -17,17 +261,18 @@ class BarrierOption():
             volatility     (float): annual volatility of underlying
             risk_free_rate (float): annual risk free rate
         """
-        if option_type != "call" and option_type != "put":
-            print('Error!\nPlease make sure option_type="call" or option_type="put"')
-            sys.exit()
+        if option_type not in OPTION_CODES:
+            raise ValueError('Please make sure option_type="call" or option_type="put"')
 
-        if barrier_type != "up_and_out" and barrier_type != "down_and_out" and barrier_type != "up_and_in" and barrier_type != "down_and_in":
-            print('Error!\nPlease make sure barrier_type="up_and_out" or barrier_type="down_and_out" or barrier_type="up_and_in" or barrier_type="down_and_in"')
-            sys.exit()
+        if barrier_type not in BARRIER_CODES:
+            raise ValueError('Please make sure barrier_type="up_and_out" or barrier_type="down_and_out" or barrier_type="up_and_in" or barrier_type="down_and_in"')
 
         if volatility < 0 or volatility > 1:
-            print("Error!\nPlease make sure 0 <= volatility <= 1")
-            sys.exit()
+            raise ValueError("Please make sure 0 <= volatility <= 1")
+
+        #Paths are followed in log space, so both prices must be strictly positive
+        if S0 <= 0 or B <= 0:
+            raise ValueError("Please make sure S0 > 0 and B > 0")
         
         self.option_type    = option_type
         self.barrier_type   = barrier_type
@@ -37,6 +282,15 @@ class BarrierOption():
         self.T              = T
         self.volatility     = volatility
         self.risk_free_rate = risk_free_rate
+
+        #Signs that turn every option and barrier type into the same call / up barrier comparison
+        self._opt_code      = OPTION_CODES[option_type]
+        self._bar_code      = BARRIER_CODES[barrier_type]
+        self._is_out        = self._bar_code == UP_OUT or self._bar_code == DOWN_OUT
+        self._call_sign     = 1.0 if self._opt_code == CALL else -1.0
+        self._sign          = 1.0 if self._bar_code == UP_OUT or self._bar_code == UP_IN else -1.0
+        self._keep_if_hit   = not self._is_out
+        self._discount      = np.exp(-risk_free_rate*T)
     
 
     def contract_specification(self) -> None:
@@ -61,130 +315,456 @@ class BarrierOption():
 
         Paramters
         ---------
-            value (list of floats): values to be discounted 
+            value (float or array of floats): values to be discounted 
 
         Returns
         --------
-            pv    (list of floats): present value 
+            pv    (float or array of floats): present value 
         """
-        pv = np.array(value)*np.exp(-self.risk_free_rate*self.T)
+        pv = value*self._discount
         return pv
 
 
-    def vanilla_payoff(self, expiration_prices):
+    def signed_extreme(self, series):
+        """
+        Calculate the extreme of each path that is checked against the barrier, flipping the sign of down barriers
+        turns their minimum into a maximum
+
+        Parameters
+        ----------
+            series  (array of floats): price or log price series, one path per row
+
+        Returns
+        ----------
+            extreme (array of floats): maximum of each path for up barriers, minus its minimum for down barriers
+        """
+        #Branch on the sign rather than multiplying the tile by it, which would build a temporary of its full size
+        if self._sign > 0:
+            return np.max(series, axis=1)
+        extreme = np.min(series, axis=1)
+        extreme *= -1
+        return extreme
+
+
+    def vanilla_payoff(self, expiration_prices, out=None):
         """
         Given the price of the underlying at maturity, calculate the payoff of the vanilla option
 
         Parameters
         ----------
-            expiration_prices (list of floats): price of the underlying at maturity
+            expiration_prices (array of floats): price of the underlying at maturity
+            out               (array of floats): optional preallocated array where the payoff is written
 
         Returns
         ----------
-            payoff            (list of floats): payoff 
+            payoff            (array of floats): payoff 
         """
+        if numba is not None:
+            return _payoff_ufunc(self._opt_code)(expiration_prices, self.K, out=out)
 
-        if self.option_type == "call":
-            payoff = np.maximum(expiration_prices - self.K, 0)
-        
-        #if self.option_type == "put"
+        #Without a buffer the payoff is computed in a float array even for integer prices
+        if out is None:
+            payoff = np.subtract(expiration_prices, self.K, dtype=np.result_type(expiration_prices, 1.0))
         else:
-            payoff = np.maximum(self.K - expiration_prices, 0)
-
+            payoff = np.subtract(expiration_prices, self.K, out=out)
+        payoff *= self._call_sign
+        payoff = np.maximum(payoff, 0, out=out)
         return payoff
     
 
 
-    def contract_payoff(self, price_series):
+    def contract_payoff(self, price_series, out=None):
         """
         Given the price series of a path, calculate the payoff of the barrier option
 
         Parameters
         ----------
-            price_series   (list of floats): price series whose payoff we need to determine
+            price_series  (array of floats): price series whose payoff we need to determine, one path per row
+            out           (array of floats): optional preallocated array where the payoff is written
 
         Returns
         ----------
-            payoff         (list of floats): payoff of each price series
+            payoff        (array of floats): payoff of each price series
         """
-        price_series = np.array(price_series)
-        payoff = []
-        if self.barrier_type == "up_and_out" or self.barrier_type == "up_and_in":
-            max_price = np.max(price_series, axis=1) 
-            barrier_reached = np.where(max_price >= self.B, 1, 0)
-            if self.barrier_type == "up_and_out":
-                for iter in range(len(barrier_reached)):
-                    if barrier_reached[iter] == 1:
-                        payoff.append(0)
-                    
-                    else:
-                        payoff.append(self.vanilla_payoff(price_series[iter, -1]))
+        barrier_reached = self.signed_extreme(price_series) >= self._sign*self.B
+        alive = barrier_reached == self._keep_if_hit
 
-            #if self.barrier_type == "up_and_in"
-            else:
-                for iter in range(len(barrier_reached)):
-                    if barrier_reached[iter] == 0:
-                        payoff.append(0)
-                    
-                    else:
-                        payoff.append(self.vanilla_payoff(price_series[iter, -1]))
+        payoff = self.vanilla_payoff(price_series[:, -1], out=out)
+        payoff *= alive
+        return payoff
+
+
+    def bridge_extreme(self, start_log_price, log_price_series, step_volatility, rng, dtype=np.float64):
+        """
+        Sample the extreme of the continuous path between consecutive simulated log prices with the Brownian bridge,
+        given x0 and x1 the conditional maximum is (x0 + x1 + sqrt((x1 - x0)^2 - 2*vol^2*dt*log(U)))/2 with U ~ U(0,1)
+        (the minimum subtracts the square root). This removes the bias of only observing the barrier at the steps
 
-        #if self.barrier_type == "down_and_out" or self.barrier_type == "down_and_in"
+        Parameters
+        ----------
+            start_log_price   (array of floats): log price of each path before its first column
+            log_price_series  (array of floats): consecutive log prices, one path per row
+            step_volatility          (float): volatility of the log price over one step, vol*sqrt(dt)
+            rng        (numpy Generator): random number generator
+            dtype          (numpy dtype): floating point type of the simulated log prices
+
+        Returns
+        ----------
+            signed_extreme    (array of floats): maximum of each path for up barriers, minus its minimum for down barriers
+        """
+        #Only two buffers the size of the tile are live, the bridge spread and the gap between consecutive prices
+        step_variance = dtype(step_volatility**2)
+        gap = np.empty_like(log_price_series)
+        np.subtract(log_price_series[:, 0], start_log_price, out=gap[:, 0])
+        np.subtract(log_price_series[:, 1:], log_price_series[:, :-1], out=gap[:, 1:])
+        gap *= gap
+
+        #log(1 - U) with U in [0, 1) never reaches log(0)
+        spread = rng.random(size=log_price_series.shape, dtype=dtype)
+        np.negative(spread, out=spread)
+        np.log1p(spread, out=spread)
+        spread *= -2*step_variance
+        spread += gap
+        np.sqrt(spread, out=spread)
+
+        #The gap buffer is reused for x0 + x1, for down barriers the signed extreme -min is the max of -(x0 + x1 - spread)/2
+        np.add(log_price_series[:, 0], start_log_price, out=gap[:, 0])
+        np.add(log_price_series[:, 1:], log_price_series[:, :-1], out=gap[:, 1:])
+        gap *= self._sign
+        gap += spread
+        gap *= 0.5
+        return np.max(gap, axis=1)
+
+
+    def log_contract_payoff(self, log_price_series, out=None, signed_extreme=None):
+        """
+        Given the log price series of a path, calculate the payoff of the barrier option.
+        The log is monotonic, so the barrier is checked against log(B) and only the terminal
+        prices of the paths that pay something are exponentiated
+
+        Parameters
+        ----------
+            log_price_series (array of floats): log price series whose payoff we need to determine, one path per row
+            out              (array of floats): optional preallocated array where the payoff is written
+            signed_extreme   (array of floats): optional extreme of each path to check against the barrier
+                                                (as returned by bridge_extreme), by default taken from the series
+
+        Returns
+        ----------
+            payoff           (array of floats): payoff of each price series
+        """
+        if signed_extreme is None:
+            signed_extreme = self.signed_extreme(log_price_series)
+
+        #The threshold is rounded like the series, so a path starting exactly on the barrier still reaches it
+        barrier_reached = signed_extreme >= log_price_series.dtype.type(self._sign*np.log(self.B))
+        paying = np.flatnonzero(barrier_reached == self._keep_if_hit)
+
+        if out is None:
+            out = np.zeros(log_price_series.shape[0], dtype=log_price_series.dtype)
         else:
-            min_price = np.min(price_series, axis=1)
-            barrier_reached = np.where(min_price <= self.B, 1, 0)
-            if self.barrier_type == "down_and_out":
-                for iter in range(len(barrier_reached)):
-                    if barrier_reached[iter] == 1:
-                        payoff.append(0)
+            out[...] = 0
 
-                    else:
-                        payoff.append(self.vanilla_payoff(price_series[iter, -1]))
-            
-            #if self.barrier_type == "down_and_in"
-            else:
-                for iter in range(len(barrier_reached)):
-                    if barrier_reached[iter] == 0:
-                        payoff.append(0)
+        #The vanilla payoff is evaluated once over all the paying paths, in place on their terminal prices
+        terminal = np.exp(log_price_series[paying, -1])
+        out[paying] = self.vanilla_payoff(terminal, out=terminal)
+        return out
+
+
+    def simulate_log_paths(self, steps, num_iters, rng, dtype=np.float64, antithetic=False):
+        """
+        Simulate log price paths of the underlying following a Geometric Brownian Motion,
+        each log price being the cumulative sum of the Gaussian increments
+
+        Parameters
+        ----------
+            steps              (int): number of steps in each simulated path
+            num_iters          (int): number of paths to simulate
+            rng   (numpy Generator): random number generator
+            dtype       (numpy dtype): floating point type of the simulated log prices
+            antithetic        (bool): if True every odd row mirrors the random shocks of the row before it
+
+        Returns
+        ----------
+            log_price (array of floats): simulated log prices, one path of steps + 1 log prices per row
+        """
+        step_drift = dtype((self.risk_free_rate - 0.5*self.volatility**2)*(self.T/steps))
+        step_volatility = dtype(self.volatility*np.sqrt(self.T/steps))
+        log_S0 = dtype(np.log(self.S0))
+        log_price = np.empty((num_iters, steps + 1), dtype=dtype)
+        increments = log_price[:, 1:]
+        if antithetic:
+            shocks = rng.standard_normal(size=((num_iters + 1)//2, steps), dtype=dtype)
+            shocks *= step_volatility
+            np.add(step_drift, shocks, out=increments[0::2])
+            np.subtract(step_drift, shocks[:num_iters//2], out=increments[1::2])
+
+        else:
+            #The generator only fills contiguous arrays, so the whole array is drawn and the first column overwritten
+            rng.standard_normal(out=log_price, dtype=dtype)
+            increments *= step_volatility
+            increments += step_drift
+
+        np.cumsum(increments, axis=1, out=increments)
+        increments += log_S0
+        log_price[:, 0] = log_S0
+
+        return log_price
+
+
+    def simulate_paths(self, steps, num_iters, rng, dtype=np.float64, antithetic=False):
+        """
+        Simulate price paths of the underlying following a Geometric Brownian Motion
+
+        Parameters
+        ----------
+            steps              (int): number of steps in each simulated path
+            num_iters          (int): number of paths to simulate
+            rng   (numpy Generator): random number generator
+            dtype       (numpy dtype): floating point type of the simulated prices
+            antithetic        (bool): if True every odd row mirrors the random shocks of the row before it
+
+        Returns
+        ----------
+            end_of_step_price (array of floats): simulated prices, one path of steps + 1 prices per row
+        """
+        end_of_step_price = self.simulate_log_paths(steps, num_iters, rng, dtype=dtype, antithetic=antithetic)
+        np.exp(end_of_step_price, out=end_of_step_price)
+
+        return end_of_step_price
+
+
+    def tiled_payoff(self, steps, num_iters, rng, tile_paths=None, chunk_paths=4096, dtype=np.float64, antithetic=False, brownian_bridge=False):
+        """
+        Simulate the paths tile by tile and reduce each tile to its payoffs straight away,
+        so that the price matrix of all the paths is never stored at once.
+        Tiles are grouped in chunks that run on a thread pool, each one with its own independent random stream
+
+        Parameters
+        ----------
+            steps              (int): number of steps in each simulated path
+            num_iters          (int): number of paths to simulate
+            rng   (numpy Generator): random number generator, a child generator is spawned for each chunk
+            tile_paths         (int): number of paths simulated together, even so that antithetic pairs stay in one tile,
+                                      by default as many as fit in CACHE_BYTES
+            chunk_paths        (int): minimum number of paths of each chunk, rounded up to a whole number of tiles
+            dtype       (numpy dtype): floating point type of the simulated prices
+            antithetic        (bool): if True every odd path mirrors the random shocks of the path before it
+            brownian_bridge   (bool): if True check the barrier against the Brownian bridge extreme between steps
+
+        Returns
+        ----------
+            payoff (array of floats): payoff of each simulated path
+        """
+        if tile_paths == None:
+            tile_paths = max(2, CACHE_BYTES//(np.dtype(dtype).itemsize*(steps + 1))//2*2)
+
+        chunk_paths = tile_paths*max(1, -(-chunk_paths//tile_paths))
+        step_volatility = self.volatility*np.sqrt(self.T/steps)
+        #The initial price already counts as an observation of the barrier, checked once in price space
+        barrier_at_start = self._sign*self.S0 >= self._sign*self.B
+        payoff = np.empty(num_iters, dtype=dtype)
+
+        def simulate_chunk(chunk_start, chunk_rng):
+            #Chunks write to disjoint slices of payoff
+            for start in range(chunk_start, min(chunk_start + chunk_paths, num_iters), tile_paths):
+                stop = min(start + tile_paths, num_iters)
+                log_price = self.simulate_log_paths(steps, stop - start, chunk_rng, dtype=dtype, antithetic=antithetic)
+                if brownian_bridge:
+                    signed_extreme = self.bridge_extreme(log_price[:, 0], log_price[:, 1:], step_volatility, chunk_rng, dtype=dtype)
+                else:
+                    signed_extreme = None
+
+                if barrier_at_start:
+                    signed_extreme = np.full(stop - start, np.inf, dtype=dtype)
+                self.log_contract_payoff(log_price, out=payoff[start:stop], signed_extreme=signed_extreme)
+
+        chunk_starts = range(0, num_iters, chunk_paths)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(simulate_chunk, chunk_starts, rng.spawn(len(chunk_starts))))
 
-                    else:
-                        payoff.append(self.vanilla_payoff(price_series[iter, -1]))
-        
         return payoff
 
 
-    def monte_carlo_pricing(self, steps, num_iters, plot=False, seed=None) -> float:
+    def knock_out_payoff(self, steps, num_iters, rng, block_paths=4096, block_steps=None, dtype=np.float64, antithetic=False, brownian_bridge=False):
+        """
+        Simulate the paths of a knock out option block by block, dropping every path as soon as
+        it reaches the barrier so that no random numbers are drawn for the rest of its life.
+        Blocks run on a thread pool, each one with its own independent random stream
+
+        Parameters
+        ----------
+            steps              (int): number of steps in each simulated path
+            num_iters          (int): number of paths to simulate
+            rng   (numpy Generator): random number generator, a child generator is spawned for each block
+            block_paths        (int): number of paths simulated together, even so that antithetic pairs stay in one block
+            block_steps        (int): number of steps simulated together before dropping knocked out paths,
+                                      by default as many as fit in CACHE_BYTES for a full block
+            dtype       (numpy dtype): floating point type of the simulated prices
+            antithetic        (bool): if True every odd path mirrors the random shocks of the path before it
+            brownian_bridge   (bool): if True check the barrier against the Brownian bridge extreme between steps
+
+        Returns
+        ----------
+            payoff (array of floats): payoff of each simulated path
+        """
+        if block_steps == None:
+            block_steps = max(1, CACHE_BYTES//(np.dtype(dtype).itemsize*block_paths))
+
+        step_drift = dtype((self.risk_free_rate - 0.5*self.volatility**2)*(self.T/steps))
+        step_volatility = dtype(self.volatility*np.sqrt(self.T/steps))
+        #Paths are followed in log space, only the terminal prices of the surviving paths are exponentiated
+        signed_log_barrier = dtype(self._sign*np.log(self.B))
+        payoff = np.zeros(num_iters, dtype=dtype)
+
+        #The initial price already counts as an observation of the barrier
+        if self._sign*self.S0 >= self._sign*self.B:
+            return payoff
+
+        def simulate_block(start, block_rng):
+            alive = np.arange(start, min(start + block_paths, num_iters))
+            log_price = np.full(alive.size, np.log(self.S0), dtype=dtype)
+
+            for step in range(0, steps, block_steps):
+                block_size = (alive.size, min(block_steps, steps - step))
+                if antithetic:
+                    #Shocks are only drawn for the pairs with at least one path alive
+                    pairs, pair_row = np.unique((alive - start)//2, return_inverse=True)
+                    shocks = block_rng.standard_normal(size=(pairs.size, block_size[1]), dtype=dtype)
+                    shocks *= step_volatility
+                    path = shocks[pair_row]
+                    mirrored = (alive - start) % 2 == 1
+                    path[mirrored] *= -1
+
+                else:
+                    path = block_rng.standard_normal(size=block_size, dtype=dtype)
+                    path *= step_volatility
+
+                path += step_drift
+                np.cumsum(path, axis=1, out=path)
+                path += log_price[:, None]
+
+                if brownian_bridge:
+                    signed_extreme = self.bridge_extreme(log_price, path, step_volatility, block_rng, dtype=dtype)
+                else:
+                    signed_extreme = self.signed_extreme(path)
+                survived = signed_extreme < signed_log_barrier
+
+                alive = alive[survived]
+                log_price = path[survived, -1]
+                if alive.size == 0:
+                    break
+
+            #Blocks write to disjoint entries of payoff
+            terminal = np.exp(log_price, out=log_price)
+            payoff[alive] = self.vanilla_payoff(terminal, out=terminal)
+
+        starts = range(0, num_iters, block_paths)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            list(executor.map(simulate_block, starts, rng.spawn(len(starts))))
+
+        return payoff
+
+
+    def monte_carlo_pricing(self, steps, num_iters, plot=False, seed=None, engine="numpy", dtype=np.float64, antithetic=False,
+                            brownian_bridge=False) -> float:
         """
         Calculate the value of the european barrier option using Monte Carlo simulations
 
         Parameters
         ----------
+            steps            (int): number of steps in each simulated path
             num_iters        (int): number of montecarlo iterations
-            plot            (bool): if True plot the montecarlo graph associated 
+            plot            (bool): if True plot the montecarlo graph associated, drawn from a separate sample of at most 500 paths
             seed             (int): select a seed for the (pseudo)random number generator
+            engine           (str): "numpy", "numba" or "cuda", the numba engine runs a compiled multithreaded
+                                    kernel and its results are only reproducible when numba runs on a single thread,
+                                    the cuda engine runs one GPU thread per path (requires cupy)
+            dtype    (numpy dtype): np.float64 or np.float32 for the simulated prices of the numpy engine,
+                                    float32 rounding is far below the Monte Carlo standard error
+            antithetic      (bool): if True simulate the paths in antithetic pairs driven by Z and -Z,
+                                    halving the normal draws needed
+            brownian_bridge (bool): if True check the barrier against the Brownian bridge extreme between steps,
+                                    removing the bias of only observing the barrier at the steps so far fewer steps are needed
         
         Returns
         ----------
             contract_price (float): estimated price for the options contract
         """
-        if seed != None:
-            np.random.seed(seed)
-        
-        #Geometric Brownian Motion
-        step_volatility = self.volatility*np.sqrt(self.T/steps) 
-        Z = np.random.normal(size=(num_iters, steps)) 
-        end_of_step_price = self.S0*np.cumprod(np.exp((self.risk_free_rate - 0.5*self.volatility**2)*(self.T/steps) + step_volatility*Z), axis=1)
-        end_of_step_price = np.concatenate((self.S0*np.ones((num_iters,1)), end_of_step_price), axis=1)
-
-        payoffs = self.contract_payoff(end_of_step_price)
-        present_value_payoffs = self.present_value(payoffs)
-        estimated_value = np.mean(present_value_payoffs)
+        if engine != "numpy" and engine != "numba" and engine != "cuda":
+            raise ValueError('Please make sure engine="numpy" or engine="numba" or engine="cuda"')
+
+        if dtype != np.float64 and dtype != np.float32:
+            raise ValueError("Please make sure dtype=np.float64 or dtype=np.float32")
+        #np.dtype instances pass the check above, the code below needs the scalar type
+        dtype = np.dtype(dtype).type
+
+        if engine == "numba" and numba is None:
+            raise ImportError('Please install numba to use engine="numba"')
+
+        if engine == "cuda" and cupy is None:
+            raise ImportError('Please install cupy to use engine="cuda"')
+
+        rng = np.random.default_rng(seed)
+
+        if engine == "numba" or engine == "cuda":
+            step_drift = (self.risk_free_rate - 0.5*self.volatility**2)*(self.T/steps)
+            step_volatility = self.volatility*np.sqrt(self.T/steps)
+            num_samples = (num_iters + 1)//2 if antithetic else num_iters
+
+            if engine == "numba":
+                if seed != None:
+                    _seed_kernel(seed)
+
+                payoff_sum, payoff_sum_squares = _mc_kernel(num_iters, steps, float(np.log(self.S0)), step_drift, step_volatility, float(np.log(self.B)), float(self.K),
+                                                            self._opt_code, self._bar_code, antithetic, brownian_bridge)
+
+            else:
+                #Only the two sums travel back from the device
+                sums = cupy.zeros(2, dtype=cupy.float64)
+                threads = 256
+                if num_samples > 0:
+                    _cuda_kernel(((num_samples + threads - 1)//threads,), (threads,),
+                                 (np.int64(num_iters), np.int64(num_samples), np.int32(steps), np.float64(np.log(self.S0)), np.float64(step_drift),
+                                  np.float64(step_volatility), np.float64(np.log(self.B)), np.float64(self.K), np.int32(self._opt_code == CALL),
+                                  np.int32(self._sign > 0), np.int32(self._is_out), np.int32(antithetic), np.int32(brownian_bridge),
+                                  np.uint64(rng.integers(2**63)), sums))
+                payoff_sum, payoff_sum_squares = sums.get()
+
+            estimated_value = self.present_value(payoff_sum/num_iters)
+            sample_mean = payoff_sum/num_iters
+            payoff_variance = max(payoff_sum_squares/num_samples - sample_mean**2, 0.0)*num_samples/max(num_samples - 1, 1)
+            standard_error = self.present_value(np.sqrt(payoff_variance/num_samples))
+
+        #Knock out paths can be dropped as soon as they reach the barrier
+        elif self._is_out:
+            payoffs = self.knock_out_payoff(steps, num_iters, rng, dtype=dtype, antithetic=antithetic, brownian_bridge=brownian_bridge)
+
+        else:
+            payoffs = self.tiled_payoff(steps, num_iters, rng, dtype=dtype, antithetic=antithetic, brownian_bridge=brownian_bridge)
+
+        #The mean is linear, so the payoffs are discounted once after averaging them
+        if engine == "numpy":
+            estimated_value = self.present_value(np.mean(payoffs, dtype=np.float64))
+            #Antithetic pairs are not independent, the standard error comes from the pair averages
+            if antithetic:
+                samples = payoffs[:num_iters - num_iters % 2].reshape(-1, 2).mean(axis=1, dtype=np.float64)
+            else:
+                samples = payoffs
+            standard_error = self.present_value(np.std(samples, ddof=1, dtype=np.float64)/np.sqrt(samples.size)) if samples.size > 1 else 0.0
+
         print(f"\nEstimated contract value: {estimated_value}")
+        print(f"Standard error:           {standard_error}")
 
         if plot == True:
-            for iter in range(num_iters):
-                plt.plot(np.linspace(0,self.T,steps + 1), end_of_step_price[iter])
-             
+            #A few hundred paths are enough to show the simulation, only these are stored and drawn as a single artist
+            plotted_paths = self.simulate_paths(steps, min(num_iters, 500), rng, dtype=dtype, antithetic=antithetic)
+            time_grid = np.broadcast_to(np.linspace(0, self.T, steps + 1), plotted_paths.shape)
+            ax = plt.gca()
+            ax.add_collection(LineCollection(np.stack((time_grid, plotted_paths), axis=-1), linewidths=0.5, alpha=0.3,
+                                             colors=plt.rcParams['axes.prop_cycle'].by_key()['color']))
+            ax.autoscale()
+
             plt.xlabel('Time')
             plt.ylabel('Price')
             plt.axhline(self.B, color="black", linewidth=2)
@@ -212,6 +792,129 @@ class BarrierOption():
 
         return estimated_value
     
+class BarrierOptionBook():
+    def __init__(self, option_types, barrier_types, S0, K, B, T, volatility, risk_free_rate) -> None:
+        """
+        Book of european barrier options on the same underlying, priced together on shared simulated paths
+
+        Parameters
+        ----------
+            option_types      (list of str): "call" or "put" for each contract
+            barrier_types     (list of str): "up_and_out" or "down_and_out" or "up_and_in" or "down_and_in" for each contract
+            S0                      (float): initial price of the underlying
+            K              (list of floats): strike price of each contract
+            B              (list of floats): barrier price of each contract
+            T              (list of floats): time to maturity in years of each contract
+            volatility     (list of floats): annual volatility of underlying for each contract
+            risk_free_rate (list of floats): annual risk free rate for each contract
+        """
+        option_types, barrier_types, K, B, T, volatility, risk_free_rate = np.broadcast_arrays(
+            np.asarray(option_types), np.asarray(barrier_types), np.asarray(K, dtype=np.float64), np.asarray(B, dtype=np.float64),
+            np.asarray(T, dtype=np.float64), np.asarray(volatility, dtype=np.float64), np.asarray(risk_free_rate, dtype=np.float64))
+
+        if not all(option_type in OPTION_CODES for option_type in option_types.flat):
+            raise ValueError('Please make sure every option_type="call" or option_type="put"')
+
+        if not all(barrier_type in BARRIER_CODES for barrier_type in barrier_types.flat):
+            raise ValueError('Please make sure every barrier_type="up_and_out" or barrier_type="down_and_out" or barrier_type="up_and_in" or barrier_type="down_and_in"')
+
+        if np.any(volatility < 0) or np.any(volatility > 1):
+            raise ValueError("Please make sure 0 <= volatility <= 1")
+
+        if S0 <= 0 or np.any(B <= 0):
+            raise ValueError("Please make sure S0 > 0 and B > 0")
+
+        self.S0             = S0
+        self.K              = K.ravel()
+        self.B              = B.ravel()
+        self.T              = T.ravel()
+        self.volatility     = volatility.ravel()
+        self.risk_free_rate = risk_free_rate.ravel()
+        self.option_code    = np.array([OPTION_CODES[option_type] for option_type in option_types.flat])
+        self.barrier_code   = np.array([BARRIER_CODES[barrier_type] for barrier_type in barrier_types.flat])
+
+        #Same signs as BarrierOption, one entry per contract
+        self._call_sign     = np.where(self.option_code == CALL, 1.0, -1.0)
+        self._is_up         = (self.barrier_code == UP_OUT) | (self.barrier_code == UP_IN)
+        self._sign          = np.where(self._is_up, 1.0, -1.0)
+        self._keep_if_hit   = (self.barrier_code == UP_IN) | (self.barrier_code == DOWN_IN)
+        self._discount      = np.exp(-self.risk_free_rate*self.T)
+
+
+    def monte_carlo_pricing(self, steps, num_iters, seed=None, dtype=np.float64):
+        """
+        Calculate the value of every contract of the book using Monte Carlo simulations.
+        One matrix of Gaussian increments and its cumulative sum is shared by the whole book,
+        contracts with the same maturity, volatility and rate share their paths and their max/min,
+        and the payoffs of all the contracts of a tile are evaluated as one (paths, contracts) matrix
+
+        Parameters
+        ----------
+            steps                 (int): number of steps in each simulated path
+            num_iters             (int): number of montecarlo iterations
+            seed                  (int): select a seed for the (pseudo)random number generator
+            dtype         (numpy dtype): np.float64 or np.float32 for the simulated log prices
+
+        Returns
+        ----------
+            contract_prices (array of floats): estimated price for each options contract
+        """
+        if dtype != np.float64 and dtype != np.float32:
+            raise ValueError("Please make sure dtype=np.float64 or dtype=np.float32")
+        #np.dtype instances pass the check above, the code below needs the scalar type
+        dtype = np.dtype(dtype).type
+
+        rng = np.random.default_rng(seed)
+        tile_paths = max(1, CACHE_BYTES//(np.dtype(dtype).itemsize*steps))
+        log_S0 = dtype(np.log(self.S0))
+        log_B = np.log(self.B).astype(dtype)
+        step_index = np.arange(1, steps + 1, dtype=dtype)
+
+        #Contracts simulated with the same dynamics share the same paths
+        dynamics, bucket = np.unique(np.stack((self.T, self.volatility, self.risk_free_rate), axis=1), axis=0, return_inverse=True)
+        bucket = bucket.ravel()
+        step_drift = ((dynamics[:, 2] - 0.5*dynamics[:, 1]**2)*(dynamics[:, 0]/steps)).astype(dtype)
+        step_volatility = (dynamics[:, 1]*np.sqrt(dynamics[:, 0]/steps)).astype(dtype)
+
+        payoff_sum = np.zeros(self.K.size)
+        payoff_sum_squares = np.zeros(self.K.size)
+        for start in range(0, num_iters, tile_paths):
+            brownian = rng.standard_normal(size=(min(tile_paths, num_iters - start), steps), dtype=dtype)
+            np.cumsum(brownian, axis=1, out=brownian)
+
+            for index in range(dynamics.shape[0]):
+                contracts = np.flatnonzero(bucket == index)
+                log_price = brownian*step_volatility[index]
+                log_price += step_drift[index]*step_index
+                log_price += log_S0
+
+                #The initial price is also an observation of the barrier
+                log_max = np.maximum(np.max(log_price, axis=1), log_S0)
+                log_min = np.minimum(np.min(log_price, axis=1), log_S0)
+                terminal = np.exp(log_price[:, -1])
+
+                sign = self._sign[contracts]
+                signed_extreme = np.where(self._is_up[contracts], log_max[:, None], -log_min[:, None])
+                alive = (signed_extreme >= sign*log_B[contracts]) == self._keep_if_hit[contracts]
+                payoff = np.maximum(self._call_sign[contracts]*(terminal[:, None] - self.K[contracts]), 0)
+                payoff *= alive
+
+                payoff_sum[contracts] += np.sum(payoff, axis=0, dtype=np.float64)
+                payoff_sum_squares[contracts] += np.sum(payoff*payoff, axis=0, dtype=np.float64)
+
+        payoff_mean = payoff_sum/num_iters
+        payoff_variance = np.maximum(payoff_sum_squares/num_iters - payoff_mean**2, 0.0)*num_iters/max(num_iters - 1, 1)
+        estimated_values = self._discount*payoff_mean
+        standard_errors = self._discount*np.sqrt(payoff_variance/num_iters)
+
+        print("\nContract    Estimated value           Standard error")
+        print("-----------------------------------------------------------------------")
+        for index in range(estimated_values.size):
+            print(f"{index:<12}{estimated_values[index]:<26}{standard_errors[index]}")
+
+        return estimated_values
+
+
 def cli():
     parser = argparse.ArgumentParser(description='CLI tool to price european barrier options via Monte Carlo simulations') 
 
@@ -225,6 +928,10 @@ def cli():
     parser.add_argument('risk_free_rate', type=float, help='annual risk free rate')
     parser.add_argument('steps',          type=int,   help='number of steps in each simulation')
     parser.add_argument('num_iters',      type=int,   help='number of simulations')
+    parser.add_argument('--engine',       type=str,   default='numpy', choices=['numpy', 'numba', 'cuda'], help='numpy, numba (compiled multithreaded kernel) or cuda (GPU kernel)')
+    parser.add_argument('--antithetic',   action='store_true', help='simulate the paths in antithetic pairs')
+    parser.add_argument('--brownian_bridge', action='store_true', help='check the barrier against the Brownian bridge extreme between steps')
+    parser.add_argument('--dtype',        type=str,   default='float64', choices=['float64', 'float32'], help='float64 or float32 (simulated prices of the numpy engine)')
 
     args = parser.parse_args()
  
@@ -238,12 +945,22 @@ def cli():
     risk_free_rate = args.risk_free_rate
     steps          = args.steps
     num_iters      = args.num_iters
-
-    option = BarrierOption(option_type, barrier_type, S0, K, B, T, volatility, risk_free_rate)
-    option.contract_specification()
-    print(f"\nNumber of steps:                {steps}")
-    print(f"Number of simulations:          {num_iters}")
-    option.monte_carlo_pricing(steps, num_iters, plot=True)
+    engine         = args.engine
+    dtype          = np.float32 if args.dtype == "float32" else np.float64
+    antithetic     = args.antithetic
+    brownian_bridge = args.brownian_bridge
+
+    try:
+        option = BarrierOption(option_type, barrier_type, S0, K, B, T, volatility, risk_free_rate)
+        option.contract_specification()
+        print(f"\nNumber of steps:                {steps}")
+        print(f"Number of simulations:          {num_iters}")
+        option.monte_carlo_pricing(steps, num_iters, plot=True, engine=engine, dtype=dtype, antithetic=antithetic,
+                                   brownian_bridge=brownian_bridge)
+
+    except (ValueError, ImportError) as error:
+        print(f"Error!\n{error}")
+        sys.exit(1)
 
 
 